@@ -15,15 +15,49 @@ XServer VPS 自动续期脚本（方案 C：清理旧未读邮件 + 自动收 Ou
 """
 
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import functools
+import inspect
 from datetime import timezone, timedelta
 import json
 import logging
+from logging.handlers import RotatingFileHandler
 import os
+import random
 import re
-from typing import Optional, Dict, List
+from typing import TYPE_CHECKING, Optional, Dict, List, Tuple
 
-from playwright.async_api import async_playwright
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
+
+if TYPE_CHECKING:
+    import aiohttp  # 仅用于类型注解；运行时在 _get_http 里懒加载
+
+
+# ======================== Playwright 调用栈开销 ==========================
+
+class _NoStackInspect:
+    """
+    playwright 每次 API 调用都会 inspect.stack() 逐帧收集调用栈（含读取源码行），
+    只用于 trace/报错里的 API 名与帧信息；返回空栈即可省掉这部分开销，其余属性照常转发
+    """
+
+    def __getattr__(self, name):
+        return getattr(inspect, name)
+
+    @staticmethod
+    def stack(context: int = 1) -> list:
+        return []
+
+
+# 默认关闭：去掉调用栈后报错里不再带 API 名（renewal.log 只剩 ": Timeout 30000ms exceeded"，看不出是 Page.goto 还是别的）。
+# 设 PW_INSPECT_STACK=0 才启用，只替换 playwright 连接层里的 inspect 引用，不影响全局
+if os.getenv("PW_INSPECT_STACK", "1") == "0":
+    try:
+        import playwright._impl._connection as _pw_connection
+        _pw_connection.inspect = _NoStackInspect()
+    except Exception:
+        pass
 
 
 # ======================== stealth（可选） ==========================
@@ -36,6 +70,98 @@ except Exception:
     stealth_async = None
     STEALTH_VERSION = "none"
 
+# 未启用 playwright-stealth 时的兜底覆盖（已压缩：每个新文档都会注入一次）
+STEALTH_SCRIPT = (
+    "Object.defineProperty(navigator,'webdriver',{get:()=>undefined});"
+    "Object.defineProperty(navigator,'plugins',{get:()=>[1,2,3]});"
+    "Object.defineProperty(navigator,'languages',{get:()=>['zh-CN','ja-JP','en-US']});"
+    "Object.defineProperty(navigator,'permissions',{get:()=>({query:({name})=>Promise.resolve({state:'granted'})})});"
+)
+
+
+# ======================== orjson（可选） ==========================
+
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None
+
+
+# ======================== 预编译正则 ==========================
+
+# 用数字前后断言而不是 \b：日文正文里数字常紧贴假名/汉字（「123456です」），两者都算 \w，\b 匹配不到
+_CODE_56 = re.compile(r"(?<!\d)(\d{5,6})(?!\d)")  # 验证码：优先 5~6 位
+_CODE_48 = re.compile(r"(?<!\d)(\d{4,8})(?!\d)")  # 验证码：兜底 4~8 位
+_IPV4 = re.compile(r"^\d{1,3}(\.\d{1,3}){3}$")
+_FETCH_UID = re.compile(rb"\bUID (\d+)")  # IMAP FETCH 响应行里的 UID
+_WS = re.compile(r"\s+")  # 主题宽松比较时去空白
+# 详情页「利用期限」同一行里的日期（表格 innerText 一行一 tr）；锚定在 利用期限 上，不会取到 利用開始 的日期
+_EXPIRY_RE = re.compile(r"利用期限[^\n]*?(\d{4})年(\d{1,2})月(\d{1,2})日")
+_XSERVER_URL = re.compile(r"^https://[^/]*xserver\.ne\.jp/")  # 只拦截 XServer 自家资源，不碰 Turnstile 等第三方
+
+
+# ======================== 时区 ==========================
+
+JST = timezone(timedelta(hours=9))  # XServer 面板时间
+CST = timezone(timedelta(hours=8))  # README 展示时间
+
+
+# ======================== 页面选择器 ==========================
+
+# 登录表单
+SEL_LOGIN_SUBMIT = "input[type='submit'], button[type='submit']"
+
+# 新环境登录验证
+SEL_SEND_CODE = "input[type='submit'][value*='送信'], button:has-text('送信'), button[type='submit'], input[type='submit']"
+SEL_CODE_INPUT = (
+    "input[type='text'], input[type='tel'], input[name*='code'], input[name*='auth'], "
+    "input[placeholder*='認証'], input[placeholder*='code' i]"
+)
+SEL_VERIFY_BTN = "button:has-text('認証'), button:has-text('確認'), input[type='submit'], button[type='submit']"
+
+# 续期两次确认（主选择器 + 宽松兜底）
+SEL_CONFIRM_BTN = "button:has-text('確認画面に進む'), a:has-text('確認画面に進む'), input[type='submit'][value*='確認']"
+SEL_CONFIRM_FALLBACK = "button:has-text('確認'), a:has-text('確認')"
+SEL_EXTEND_BTN = "button:has-text('期限を延長する'), a:has-text('期限を延長する'), input[type='submit'][value*='延長']"
+SEL_EXTEND_FALLBACK = "button:has-text('延長'), a:has-text('延長')"
+
+# 页面文案关键字（在页面内匹配，作为 evaluate 参数传入）
+ENV_VERIFY_KEYWORDS = ("新しい環境からのログイン", "ログイン用認証コード", "認証コードを送信")
+ENV_VERIFY_ALL_OF = ("認証コード", "送信")  # 同时出现也视为验证页
+EXTEND_OK_KEYWORDS = ("完了", "延長", "成功", "更新")
+
+# 页面内辅助函数：作为 Context 级 init script 在每个文档加载时解析一次，
+# 之后的 evaluate 只是一次短调用，不再每次传输/编译整段 JS。
+# 只装在 XServer 自家页面（不进 Turnstile 等第三方 iframe），且定义为不可枚举，不在 window 上多出可见的全局
+PAGE_HELPERS_JS = r"""
+if (location.hostname.endsWith('xserver.ne.jp')) {
+    const def = (name, fn) => Object.defineProperty(window, name, {value: fn, enumerable: false, configurable: true});
+    def('__xs_text', (limit) => {
+        const root = document.body;
+        const t = root ? (root.innerText || root.textContent || '') : '';
+        // 给了 limit 时压缩空白并截断，只回传一小段
+        return limit ? t.replace(/\s+/g, ' ').trim().slice(0, limit) : t;
+    });
+    def('__xs_hasKeywords', (anyOf, allOf) => {
+        const t = window.__xs_text();
+        return anyOf.some(k => t.includes(k)) || (allOf.length > 0 && allOf.every(k => t.includes(k)));
+    });
+}
+"""
+
+
+# ======================== 浏览器资源拦截 ==========================
+
+# 面板里只需要文本和按钮：这些资源类型直接 abort（保留 stylesheet，避免影响可见性判断）
+BLOCKED_RESOURCE_TYPES = ("image", "media", "font")
+
+
+async def _block_assets(route):
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        await route.abort()
+    else:
+        await route.continue_()
+
 
 # ======================== 配置 ==========================
 
@@ -43,11 +169,22 @@ class Config:
     # XServer
     LOGIN_EMAIL = os.getenv("XSERVER_EMAIL")
     LOGIN_PASSWORD = os.getenv("XSERVER_PASSWORD")
-    VPS_ID = os.getenv("XSERVER_VPS_ID", "40124478")
+    # 支持逗号分隔多个 ID：共用一个浏览器和登录态依次续期
+    VPS_IDS = [v.strip() for v in os.getenv("XSERVER_VPS_ID", "40124478").split(",") if v.strip()] or ["40124478"]
+    VPS_ID = VPS_IDS[0]
 
     # 运行参数
     USE_HEADLESS = os.getenv("USE_HEADLESS", "false").lower() == "true"
     WAIT_TIMEOUT = int(os.getenv("WAIT_TIMEOUT", "30000"))
+    DEBUG_SHOTS = os.getenv("DEBUG_SHOTS", "false").lower() == "true"  # 过程截图（失败截图不受影响）
+    SHOT_QUALITY = int(os.getenv("SHOT_QUALITY", "70"))  # 过程截图 JPEG 质量
+    # 拦截 XServer 面板的图片/字体/媒体（默认关闭，BLOCK_ASSETS=true 开启）。代价：注册任何 route 后
+    # Playwright 会关闭 HTTP 缓存，每次面板跳转都重新下载共用的 CSS/JS，且每个 XServer 请求都要回 Python
+    # 走一遍 _block_assets；净收益未实测，且会改变每次页面加载的请求特征
+    BLOCK_ASSETS = os.getenv("BLOCK_ASSETS", "false").lower() == "true"
+    CHECK_EXIT_IP = os.getenv("CHECK_EXIT_IP", "0") == "1"  # 查询浏览器出口 IP（仅用于日志/README）
+    # 登录态（Cookie/localStorage）持久化文件；留空则每次都走完整登录。内含会话 Cookie，切勿提交到仓库
+    STATE_FILE = os.getenv("STATE_FILE", "").strip()
 
     # 代理（你当前不需要全程代理：仅保留变量/日志提示，不用于 launch）
     PROXY_SERVER = os.getenv("PROXY_SERVER")
@@ -68,147 +205,472 @@ class Config:
     LOGIN_URL = "https://secure.xserver.ne.jp/xapanel/login/xvps/"
 
     # ✅ 你要求的跳转页（先访问）
-    EXTEND_INDEX_URL = f"https://secure.xserver.ne.jp/xapanel/xmgame/jumpvps/?id={VPS_ID}"
+    EXTEND_INDEX_URL_TPL = "https://secure.xserver.ne.jp/xapanel/xmgame/jumpvps/?id={}"
 
     # ✅ 然后访问续期输入页
     EXTEND_INPUT_URL = "https://secure.xserver.ne.jp/xmgame/game/freeplan/extend/input"
 
     # 旧版 xvps 到期详情（保留，用于读取到期日）
-    DETAIL_URL = f"https://secure.xserver.ne.jp/xapanel/xvps/server/detail?id={VPS_ID}"
+    DETAIL_URL_TPL = "https://secure.xserver.ne.jp/xapanel/xvps/server/detail?id={}"
 
 
 # ======================== 日志 ==========================
 
+# 轮转日志：单文件上限 512KB、保留 2 份；delay=True 到第一条日志才打开文件
+_file_handler = RotatingFileHandler("renewal.log", maxBytes=512_000, backupCount=2, encoding="utf-8", delay=True)
+_file_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s",
     handlers=[
-        logging.FileHandler("renewal.log", encoding="utf-8"),
+        _file_handler,
         logging.StreamHandler()
     ]
 )
 logger = logging.getLogger(__name__)
 
 
+# ======================== HTTP 会话（复用连接） ==========================
+
+_HTTP: Optional["aiohttp.ClientSession"] = None
+
+
+async def _get_http():
+    """懒加载全局 aiohttp 会话：同一进程内复用 keep-alive 连接，避免每次请求重复 DNS/TCP/TLS 握手"""
+    global _HTTP
+    if _HTTP is None or _HTTP.closed:
+        import aiohttp
+        _HTTP = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=20),
+        )
+    return _HTTP
+
+
+async def _close_http():
+    global _HTTP
+    if _HTTP is not None and not _HTTP.closed:
+        await _HTTP.close()
+    _HTTP = None
+
+
 # ======================== 通知器 ==========================
 
 class Notifier:
+    # 仅对限流/服务端错误/网络错误重试：指数退避 + 抖动
+    MAX_RETRIES = 3
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+    BACKOFF_BASE = 2  # 第 n 次重试前等待 BACKOFF_BASE*2^n 秒（封顶 BACKOFF_MAX）+ 0~1 秒抖动
+    BACKOFF_MAX = 8
+    RETRY_AFTER_MAX = 10  # 429 给的 retry_after 超过这个值就不再重试（等不起，提前重试也只会再被拒）
+    POST_TIMEOUT_SEC = 10  # 单次请求封顶
+    POST_TIMEOUT = None  # aiohttp.ClientTimeout，首次发送时创建（aiohttp 为懒加载）
+    # 多台 VPS 时同时在途的通知数上限（Telegram 单聊约 1 条/秒，并发过高只会换来 429 重试）
+    CONCURRENCY = max(1, int(os.getenv("NOTIFY_CONCURRENCY", "2")))
+    _SEM = asyncio.Semaphore(CONCURRENCY)
+
+    @staticmethod
+    def worst_case_sec() -> float:
+        """单条通知最坏耗时：每次请求都等满超时，每次重试前都等满上限（含 1 秒抖动）"""
+        retry_wait = max(Notifier.BACKOFF_MAX, Notifier.RETRY_AFTER_MAX) + 1
+        return Notifier.MAX_RETRIES * Notifier.POST_TIMEOUT_SEC + (Notifier.MAX_RETRIES - 1) * retry_wait
+
     @staticmethod
     async def send_telegram(message: str):
         if not all([Config.TELEGRAM_BOT_TOKEN, Config.TELEGRAM_CHAT_ID]):
             return
         try:
             import aiohttp
-            url = f"https://api.telegram.org/bot{Config.TELEGRAM_BOT_TOKEN}/sendMessage"
-            data = {"chat_id": Config.TELEGRAM_CHAT_ID, "text": message, "parse_mode": "HTML"}
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as resp:
+        except ImportError as e:
+            logger.error(f"❌ Telegram 发送失败: {e}")
+            return
+
+        if Notifier.POST_TIMEOUT is None:
+            Notifier.POST_TIMEOUT = aiohttp.ClientTimeout(total=Notifier.POST_TIMEOUT_SEC)
+
+        url = f"https://api.telegram.org/bot{Config.TELEGRAM_BOT_TOKEN}/sendMessage"
+        data = {"chat_id": Config.TELEGRAM_CHAT_ID, "text": message, "parse_mode": "HTML"}
+
+        reason = ""
+        for attempt in range(Notifier.MAX_RETRIES):
+            retry_after = None
+            try:
+                session = await _get_http()
+                # 单次请求 POST_TIMEOUT_SEC 秒封顶：Telegram 卡住时不拖住整个流程（超时按网络错误重试）
+                async with session.post(url, json=data, timeout=Notifier.POST_TIMEOUT) as resp:
                     if resp.status == 200:
                         logger.info("✅ Telegram 通知发送成功")
-                    else:
+                        return
+                    if resp.status not in Notifier.RETRY_STATUS:
                         logger.error(f"❌ Telegram 返回非 200 状态码: {resp.status}")
-        except Exception as e:
-            logger.error(f"❌ Telegram 发送失败: {e}")
+                        return
+                    reason = f"HTTP {resp.status}"
+                    if resp.status == 429:
+                        retry_after = await Notifier._retry_after(resp)
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+                reason = str(e) or type(e).__name__
+            except Exception as e:
+                logger.error(f"❌ Telegram 发送失败: {e}")
+                return
+
+            if retry_after is not None and retry_after > Notifier.RETRY_AFTER_MAX:
+                logger.error(f"❌ Telegram 限流，要求 {retry_after}s 后重试，放弃本条通知")
+                return
+            if attempt + 1 < Notifier.MAX_RETRIES:
+                if retry_after is not None:
+                    wait = retry_after + random.random()
+                else:
+                    wait = min(Notifier.BACKOFF_MAX, Notifier.BACKOFF_BASE * (2 ** attempt)) + random.random()
+                logger.warning(
+                    f"⚠️ Telegram 发送失败（{reason}），{wait:.1f}s 后重试 ({attempt + 1}/{Notifier.MAX_RETRIES})"
+                )
+                await asyncio.sleep(wait)
+
+        logger.error(f"❌ Telegram 发送失败（已重试 {Notifier.MAX_RETRIES} 次）: {reason}")
+
+    @staticmethod
+    async def _retry_after(resp) -> Optional[float]:
+        """429 应答里 Telegram 要求的等待秒数（parameters.retry_after，其次 Retry-After 头）"""
+        try:
+            body = await resp.json(content_type=None)
+            value = (body.get("parameters") or {}).get("retry_after")
+        except Exception:
+            value = None
+        if value is None:
+            value = resp.headers.get("Retry-After")
+        try:
+            return float(value) if value is not None else None
+        except (TypeError, ValueError):
+            return None
 
     @staticmethod
     async def notify(subject: str, message: str):
         # subject 预留
-        await Notifier.send_telegram(message)
+        async with Notifier._SEM:
+            await Notifier.send_telegram(message)
 
 
 # ======================== 邮箱验证码（Outlook IMAP） ==========================
 
+def _rfc2047(value) -> str:
+    """解码 RFC 2047 编码的邮件头（=?utf-8?B?...?= 等）"""
+    from email.header import decode_header
+
+    if not value:
+        return ""
+    out = []
+    for s, enc in decode_header(value):
+        if isinstance(s, bytes):
+            out.append(s.decode(enc or "utf-8", errors="ignore"))
+        else:
+            out.append(s)
+    return "".join(out)
+
+
+# IMAP 日期固定用英文月份缩写（不能用 strftime("%b")，它受 locale 影响）
+_IMAP_MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
 class EmailCodeFetcher:
     """
     通过 IMAP 拉取邮箱验证码（用于“新环境登录验证”）
     - 方案C：点击“发送验证码”前，先把旧的“验证码相关未读邮件”标记为 Seen，避免读到旧码
     - ✅ 支持日文 SUBJECT：IMAP SEARCH 只用 ASCII（UNSEEN），From/Subject 过滤在本地（Unicode）做
+    - 两段式 FETCH：先只取头部做过滤，命中后再取正文；全程 PEEK，不会隐式标记已读
     """
 
+    # 头部里带上 Content-Type/CTE，正文拼回去后才能按 MIME 正常解析
+    HEADER_FETCH = "(BODY.PEEK[HEADER.FIELDS (SUBJECT FROM CONTENT-TYPE CONTENT-TRANSFER-ENCODING)])"
+    TEXT_FETCH = "(BODY.PEEK[TEXT])"
+    # 验证码基本都在正文开头：先只取前 16KB，找不到且正文更长时才取完整正文
+    TEXT_HEAD_BYTES = 16384
+    TEXT_HEAD_FETCH = f"(BODY.PEEK[TEXT]<0.{TEXT_HEAD_BYTES}>)"
+
+    # 无 IDLE 时的轮询间隔：从 START 开始每轮乘 FACTOR，封顶 MAX（秒）；刚到过邮件时重置
+    POLL_DELAY_START = float(os.getenv("MAIL_POLL_START", "0.5"))
+    POLL_DELAY_FACTOR = float(os.getenv("MAIL_POLL_FACTOR", "1.5"))
+    POLL_DELAY_MAX = float(os.getenv("MAIL_POLL_MAX", "4.0"))
+    KEEPALIVE_SEC = 30  # 连接空闲超过这么久才先 NOOP 一次
+
     def __init__(self):
         self.host = Config.MAIL_IMAP_HOST
         self.user = Config.MAIL_IMAP_USER
         self.password = Config.MAIL_IMAP_PASS
         self.from_filter = Config.MAIL_FROM_FILTER
         self.subject_filter = Config.MAIL_SUBJECT_FILTER
+        # 过滤条件的归一化形式只算一次，_match_filters 每封邮件直接比较
+        self._from_filter_lc = self.from_filter.lower()
+        self._subject_filter_compact = _WS.sub("", self.subject_filter)
+        self._mail = None  # 复用的 IMAP 连接（见 _ensure_conn）
+        self._last_used = 0.0  # 上次在该连接上收发命令的时间（time.monotonic）
+        # 所有阻塞 IMAP 调用都在这一个专用线程里执行：连接不会被多线程同时使用，也不占默认线程池
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="imap")
+        # SEARCH 条件只取决于配置（SINCE 已放宽一天，跨零点也不会漏信）：构造一次，每轮复用
+        self._criteria = self._build_search_criteria()
 
     def _extract_code(self, text: str) -> Optional[str]:
         if not text:
             return None
         # 优先 5~6 位（常见 5 位）
-        m = re.search(r"\b(\d{5,6})\b", text)
+        m = _CODE_56.search(text)
         if m:
             return m.group(1)
         # 兜底 4~8 位
-        m = re.search(r"\b(\d{4,8})\b", text)
+        m = _CODE_48.search(text)
         return m.group(1) if m else None
 
-    def _decode_email_payload(self, msg) -> str:
-        from email.header import decode_header
-
-        def decode_header_value(v):
-            if not v:
-                return ""
-            parts = decode_header(v)
-            out = []
-            for s, enc in parts:
-                if isinstance(s, bytes):
-                    out.append(s.decode(enc or "utf-8", errors="ignore"))
+    def _decode_headers(self, msg) -> Tuple[str, str]:
+        """只解码 Subject/From（每封邮件解码一次，供过滤与取码复用）；正文按需由 _iter_text_parts 逐段解码"""
+        return _rfc2047(msg.get("Subject")), _rfc2047(msg.get("From"))
+
+    def _iter_text_parts(self, msg):
+        """
+        逐个产出解码后的正文：text/plain 优先，text/html 兜底
+        调用方找到验证码即可停止迭代，HTML 等后续 part 不会被解码
+        """
+        if not msg.is_multipart():
+            yield self._decode_part(msg)
+            return
+
+        # text/plain 边遍历边产出（命中即停，后面的 part 不再遍历）；text/html 先记下，最后再解码
+        html_parts = []
+        for part in msg.walk():
+            ctype = part.get_content_type()
+            if ctype not in ("text/plain", "text/html"):
+                continue
+            if "attachment" in str(part.get("Content-Disposition") or ""):
+                continue
+            if ctype == "text/html":
+                html_parts.append(part)
+                continue
+            yield self._decode_part(part)
+
+        for part in html_parts:
+            yield self._decode_part(part)
+
+    @staticmethod
+    def _decode_part(part) -> str:
+        payload = part.get_payload(decode=True) or b""
+        charset = part.get_content_charset() or "utf-8"
+        return payload.decode(charset, errors="ignore")
+
+    @staticmethod
+    def _fetch_literal(mail, uid: bytes, spec: str) -> Optional[bytes]:
+        """执行一次 UID FETCH，返回响应里的原始字节（失败返回 None）"""
+        typ, data = mail.uid("FETCH", uid, spec)
+        if typ != "OK" or not data:
+            return None
+        for item in data:
+            if isinstance(item, tuple) and len(item) >= 2:
+                return item[1]
+        return None
+
+    def _fetch_headers(self, mail, uids: List[bytes]) -> Dict[bytes, bytes]:
+        """
+        一条 UID FETCH 批量取回多封邮件的头部（一次往返，服务器流式返回）
+        返回 {uid: 原始头部字节}；响应顺序由服务器决定，按 UID 对应回去
+        """
+        if not uids:
+            return {}
+        typ, data = mail.uid("FETCH", b",".join(uids), self.HEADER_FETCH)
+        if typ != "OK" or not data:
+            return {}
+        headers = {}
+        pending = None  # UID 出现在字面量之后的服务器：先暂存字节，等收尾行里的 UID
+        for item in data:
+            # 每封邮件是 (b'<seq> (UID <uid> BODY[...] {n}', 原始字节)，后面跟着 b')' 或 b' UID <uid>)'
+            if isinstance(item, tuple) and len(item) >= 2:
+                m = _FETCH_UID.search(item[0])
+                if m:
+                    headers[m.group(1)] = item[1]
+                    pending = None
                 else:
-                    out.append(s)
-            return "".join(out)
-
-        subject = decode_header_value(msg.get("Subject"))
-        from_ = decode_header_value(msg.get("From"))
-
-        body_texts = []
-        if msg.is_multipart():
-            for part in msg.walk():
-                ctype = part.get_content_type()
-                disp = str(part.get("Content-Disposition") or "")
-                if ctype in ("text/plain", "text/html") and "attachment" not in disp:
-                    payload = part.get_payload(decode=True) or b""
-                    charset = part.get_content_charset() or "utf-8"
-                    body_texts.append(payload.decode(charset, errors="ignore"))
-        else:
-            payload = msg.get_payload(decode=True) or b""
-            charset = msg.get_content_charset() or "utf-8"
-            body_texts.append(payload.decode(charset, errors="ignore"))
+                    pending = item[1]
+            elif pending is not None and isinstance(item, bytes):
+                m = _FETCH_UID.search(item)
+                if m:
+                    headers[m.group(1)] = pending
+                pending = None
+        return headers
+
+    def _fetch_full(self, mail, uid: bytes, raw_headers: bytes, spec: str = TEXT_FETCH):
+        """
+        在已取到的头部后面拼上正文，得到可按 MIME 解析的邮件
+        返回 (邮件对象, 取回的正文字节数)；spec 为部分 FETCH 时邮件可能被截断
+        """
+        import email
 
-        combined = "\n".join(body_texts)
-        return f"SUBJECT:\n{subject}\n\nFROM:\n{from_}\n\nBODY:\n{combined}"
+        body = self._fetch_literal(mail, uid, spec)
+        if body is None:
+            return None, 0
+        raw_headers = raw_headers.rstrip(b"\r\n") + b"\r\n\r\n"
+        return email.message_from_bytes(raw_headers + body), len(body)
+
+    def _find_code(self, msg, subject: str) -> Optional[str]:
+        """先看 Subject，再逐段扫正文，命中即返回"""
+        code = self._extract_code(subject)
+        if code:
+            return code
+        for text in self._iter_text_parts(msg):
+            code = self._extract_code(text)
+            if code:
+                return code
+        return None
 
-    def _build_search_criteria(self) -> List[str]:
+    def _build_search_criteria(self) -> Tuple[bytes, ...]:
         """
         ✅ 为了支持日文等非 ASCII Subject：
-        - IMAP SEARCH 这里只返回纯 ASCII 条件（UNSEEN）
-        - 发件人/主题过滤改为本地过滤（见 _match_filters）
+        - IMAP SEARCH 这里只返回纯 ASCII 条件（UNSEEN + SINCE，FROM 仅在过滤值为 ASCII 时下推）
+        - 发件人/主题过滤仍在本地做一遍（见 _match_filters）
         """
-        return ["UNSEEN"]
-
-    def _match_filters(self, decoded_payload: str) -> bool:
+        criteria = ["UNSEEN"]
+        if self.from_filter and self.from_filter.isascii():
+            quoted = self.from_filter.replace("\\", "\\\\").replace('"', '\\"')
+            criteria += ["FROM", f'"{quoted}"']
+        # SINCE 按服务器时区的日期比较：往前放宽一天，避免跨时区把刚到的邮件排除掉
+        since = datetime.date.today() - timedelta(days=1)
+        criteria += ["SINCE", f"{since.day:02d}-{_IMAP_MONTHS[since.month - 1]}-{since.year}"]
+        # 预先编码成 bytes：imaplib 对 bytes 参数原样发送
+        return tuple(c.encode("ascii") for c in criteria)
+
+    def _match_filters(self, subject: str, from_: str) -> bool:
         """
         本地过滤：支持日文/中文/任何 Unicode
-        decoded_payload 是 _decode_email_payload() 的输出，包含 SUBJECT/FROM/BODY
+        subject/from_ 是 _decode_headers() 的输出（已解码）
         """
-        if not decoded_payload:
+        if not (subject or from_):
             return False
 
         if self.from_filter:
-            if self.from_filter.lower() not in decoded_payload.lower():
+            if self._from_filter_lc not in from_.lower():
                 return False
 
         if self.subject_filter:
             # 直接 Unicode 匹配
-            if self.subject_filter not in decoded_payload:
+            if self.subject_filter not in subject:
                 # 宽松兜底：去掉空白再比一次
-                compact_payload = re.sub(r"\s+", "", decoded_payload)
-                compact_filter = re.sub(r"\s+", "", self.subject_filter)
-                if compact_filter not in compact_payload:
+                compact_subject = _WS.sub("", subject)
+                if self._subject_filter_compact not in compact_subject:
                     return False
 
         return True
 
+    def _ensure_conn(self):
+        """
+        复用同一个 IMAP 连接：TLS 握手 + LOGIN + SELECT INBOX 只做一次
+        - 已有连接：距上次使用超过 KEEPALIVE_SEC 才发 NOOP 探活，防止中间设备掐掉空闲 TLS
+        - 连接失效：丢弃后重连（命令本身遇到 abort/OSError 时由调用方 close）
+        """
+        import imaplib
+        import time
+
+        now = time.monotonic()
+        if self._mail is not None:
+            if now - self._last_used < self.KEEPALIVE_SEC:
+                self._last_used = now
+                return self._mail
+            try:
+                self._mail.noop()
+                self._last_used = now
+                return self._mail
+            except Exception:
+                self.close()
+
+        mail = imaplib.IMAP4_SSL(self.host)
+        mail.login(self.user, self.password)
+        mail.select("INBOX")
+        self._mail = mail
+        self._last_used = now
+        return mail
+
+    def _idle_wait(self, timeout: float) -> bool:
+        """
+        IMAP IDLE（RFC 2177）：在已登录的连接上阻塞等待服务器推送，最长 timeout 秒
+        返回 True 表示收到新邮件（EXISTS）；服务器不支持/拒绝 IDLE 时抛异常，由调用方退回轮询
+        """
+        import select
+        import time
+
+        mail = self._mail or self._ensure_conn()
+        if "IDLE" not in mail.capabilities:
+            raise RuntimeError("服务器不支持 IDLE")
+
+        # 上一轮 SEARCH/NOOP 期间已经推送过的 EXISTS：不用再等
+        if mail.untagged_responses.pop("EXISTS", None):
+            return True
+
+        # IDLE 期间改用不带缓冲的 reader 逐行读：imaplib 的 mail.file 是 BufferedReader，
+        # readline() 会把同一 TLS 记录里后续的行（如紧跟「+ idling」的 * n EXISTS）预读进缓冲，
+        # 这些行 select() 和 sock.pending() 都看不到，会白等满整个窗口
+        sock = mail.sock
+        reader = sock.makefile("rb", buffering=0)
+        pending = getattr(sock, "pending", lambda: 0)  # SSL 层已解密但未读走的数据，select 看不到
+
+        def readline() -> bytes:
+            line = reader.readline()
+            if not line:
+                raise OSError("IMAP 连接已关闭")
+            return line
+
+        try:
+            tag = mail._new_tag()
+            mail.send(tag + b" IDLE\r\n")
+            arrived = False
+            while True:
+                line = readline()
+                if line.startswith(b"+"):
+                    break
+                if line.startswith(tag):
+                    raise RuntimeError(f"IDLE 被拒绝: {line.strip()!r}")
+                if line.rstrip().endswith(b"EXISTS"):
+                    arrived = True
+
+            try:
+                deadline = time.monotonic() + timeout
+                while not arrived:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    if not pending() and not select.select([sock], [], [], remaining)[0]:
+                        break
+                    if readline().rstrip().endswith(b"EXISTS"):
+                        arrived = True
+            finally:
+                # 结束 IDLE，并读完到本次 tagged 应答为止，连接回到可发命令的状态；
+                # 这期间到达的 EXISTS 同样算数
+                mail.send(b"DONE\r\n")
+                while True:
+                    line = readline()
+                    if line.startswith(tag):
+                        break
+                    if line.rstrip().endswith(b"EXISTS"):
+                        arrived = True
+                self._last_used = time.monotonic()
+        finally:
+            reader.close()
+        return arrived
+
+    async def run_blocking(self, fn, *args):
+        """在 IMAP 专用线程里执行阻塞调用"""
+        return await asyncio.get_running_loop().run_in_executor(self._pool, functools.partial(fn, *args))
+
+    async def shutdown(self) -> None:
+        """登出并回收 IMAP 线程（运行结束时调用一次）"""
+        try:
+            await self.run_blocking(self.close)
+        finally:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def close(self) -> None:
+        if self._mail is None:
+            return
+        try:
+            self._mail.logout()
+        except Exception:
+            pass
+        self._mail = None
+
     def mark_old_unseen_as_seen(self) -> None:
         """
         方案C核心：清掉旧的未读验证码邮件，避免拿到旧验证码
@@ -218,127 +680,181 @@ class EmailCodeFetcher:
             logger.warning("⚠️ 未配置 MAIL_IMAP_*，无法清理旧未读验证码邮件")
             return
 
-        import imaplib
         import email
+        import imaplib
 
         try:
-            mail = imaplib.IMAP4_SSL(self.host)
-            mail.login(self.user, self.password)
-            mail.select("INBOX")
+            mail = self._ensure_conn()
 
-            criteria = self._build_search_criteria()  # ["UNSEEN"]
-            typ, data = mail.search(None, *criteria)
+            typ, data = mail.uid("SEARCH", *self._criteria)  # UNSEEN [FROM ...] SINCE ...
             if typ != "OK":
-                mail.logout()
                 logger.warning(f"⚠️ IMAP search 失败(清理阶段): {typ}")
                 return
 
-            ids = data[0].split()
-            if not ids:
-                mail.logout()
+            uids = data[0].split()
+            if not uids:
                 logger.info("🧹 清理阶段：没有旧的未读邮件")
                 return
 
-            cleared = 0
             # 只清理“符合过滤条件”的未读邮件，避免误伤其他未读
-            for mid in ids:
+            matched = []
+            for uid, raw_hdr in self._fetch_headers(mail, uids).items():
                 try:
-                    typ, msg_data = mail.fetch(mid, "(RFC822)")
-                    if typ != "OK":
-                        continue
-                    raw = msg_data[0][1]
-                    msg = email.message_from_bytes(raw)
-                    content = self._decode_email_payload(msg)
-
-                    if self._match_filters(content):
-                        mail.store(mid, "+FLAGS", "\\Seen")
-                        cleared += 1
+                    subject, from_ = self._decode_headers(email.message_from_bytes(raw_hdr))
                 except Exception:
                     continue
+                if self._match_filters(subject, from_):
+                    matched.append(uid)
+
+            cleared = 0
+            if matched:
+                # 一条 UID STORE 带整个 UID 集合，一次往返；失败再逐封兜底
+                try:
+                    batch_ok = mail.uid("STORE", b",".join(matched), "+FLAGS", "\\Seen")[0] == "OK"
+                except mail.error:
+                    batch_ok = False
+                if batch_ok:
+                    cleared = len(matched)
+                else:
+                    for uid in matched:
+                        try:
+                            if mail.uid("STORE", uid, "+FLAGS", "\\Seen")[0] == "OK":
+                                cleared += 1
+                        except Exception:
+                            continue
 
-            mail.logout()
             if cleared > 0:
                 logger.info(f"🧹 清理阶段：已将 {cleared} 封旧未读验证码邮件标记为已读（避免旧验证码干扰）")
             else:
                 logger.info("🧹 清理阶段：未发现符合过滤条件的旧未读验证码邮件")
 
         except Exception as e:
+            if isinstance(e, (imaplib.IMAP4.abort, OSError)):
+                self.close()
             logger.warning(f"⚠️ 清理旧未读验证码邮件失败（将继续尝试正常收码）: {e}")
 
-    def fetch_latest_code(self, timeout_sec: int = 120, poll_interval: int = 5) -> Optional[str]:
+    def _poll_once(self) -> Tuple[Optional[str], bool]:
+        """
+        单轮收码（阻塞 IMAP 调用，由 fetch_latest_code 放到 IMAP 专用线程里执行）
+        返回 (验证码, 是否存在未读邮件)
+        """
+        import email
+
+        mail = self._ensure_conn()
+        # 之前积累的 EXISTS 已被本轮 SEARCH 覆盖；之后再出现的才是 _idle_wait 要等的新邮件
+        mail.untagged_responses.pop("EXISTS", None)
+
+        typ, data = mail.uid("SEARCH", *self._criteria)  # UNSEEN [FROM ...] SINCE ...
+        if typ != "OK":
+            raise Exception(f"IMAP search failed: {typ}")
+
+        uids = data[0].split()
+        if not uids:
+            return None, False
+
+        # 取最近 N 封未读，防止未读堆积卡在无关邮件
+        tail_n = 20
+        uids_to_check = uids[-tail_n:]
+        headers = self._fetch_headers(mail, uids_to_check)
+
+        # 新邮件优先（UID 越大越新）
+        for uid in sorted(headers, key=int, reverse=True):
+            raw_hdr = headers[uid]
+            subject, from_ = self._decode_headers(email.message_from_bytes(raw_hdr))
+
+            if not self._match_filters(subject, from_):
+                continue
+
+            # 只有命中过滤条件的邮件才下载正文（先取开头一段）
+            msg, size = self._fetch_full(mail, uid, raw_hdr, self.TEXT_HEAD_FETCH)
+            if msg is None:
+                continue
+
+            code = self._find_code(msg, subject)
+            if not code and size >= self.TEXT_HEAD_BYTES:
+                msg, _ = self._fetch_full(mail, uid, raw_hdr)
+                if msg is None:
+                    continue
+                code = self._find_code(msg, subject)
+            if code:
+                mail.uid("STORE", uid, "+FLAGS", "\\Seen")
+                return code, True
+
+            # 符合过滤但没码：标已读，避免反复卡住
+            mail.uid("STORE", uid, "+FLAGS", "\\Seen")
+
+        return None, bool(headers)
+
+    async def fetch_latest_code(self, timeout_sec: int = 120, poll_interval: int = 5) -> Optional[str]:
         """
         轮询获取“新来的未读验证码邮件”
         ✅ 支持日文过滤：UNSEEN + 本地过滤 subject/from
+        ✅ 整个轮询期间复用同一个 IMAP 连接（见 _ensure_conn），每轮只发 NOOP + SEARCH
+        ✅ 服务器支持 IDLE 时两轮之间挂在 IDLE 上，新邮件一到就立刻 SEARCH；
+           否则按 POLL_DELAY_* 递增间隔轮询（验证码通常几秒内到达，前几轮查得更勤）
+        ✅ 等待/退避都在事件循环上 await，只有单轮 IMAP 往返进专用线程，超时与取消都能及时生效
         """
         if not all([self.host, self.user, self.password]):
             logger.warning("⚠️ 未配置 MAIL_IMAP_*，无法自动收取邮箱验证码")
             return None
 
         import imaplib
-        import email
-        import time
-        from datetime import datetime, timezone
 
-        end_time = datetime.now(timezone.utc).timestamp() + timeout_sec
+        loop = asyncio.get_running_loop()
+        end_time = loop.time() + timeout_sec
+        retry_idx = 0  # 连续失败次数，用于指数退避
+        use_idle = True
+        delay = self.POLL_DELAY_START
 
-        while datetime.now(timezone.utc).timestamp() < end_time:
+        while loop.time() < end_time:
             try:
-                mail = imaplib.IMAP4_SSL(self.host)
-                mail.login(self.user, self.password)
-                mail.select("INBOX")
-
-                criteria = self._build_search_criteria()  # ["UNSEEN"]
-                typ, data = mail.search(None, *criteria)
-                if typ != "OK":
-                    mail.logout()
-                    raise Exception(f"IMAP search failed: {typ}")
-
-                ids = data[0].split()
-                if not ids:
-                    mail.logout()
-                    logger.info("📭 暂无新验证码邮件，继续等待...")
-                    time.sleep(poll_interval)
-                    continue
-
-                # 取最近 N 封未读，防止未读堆积卡在无关邮件
-                tail_n = 20
-                ids_to_check = ids[-tail_n:]
-
-                found_any_unread = False
-                for mid in reversed(ids_to_check):
-                    typ, msg_data = mail.fetch(mid, "(RFC822)")
-                    if typ != "OK":
-                        continue
-
-                    found_any_unread = True
-                    raw = msg_data[0][1]
-                    msg = email.message_from_bytes(raw)
-                    content = self._decode_email_payload(msg)
-
-                    if not self._match_filters(content):
-                        continue
-
-                    code = self._extract_code(content)
-                    if code:
-                        mail.store(mid, "+FLAGS", "\\Seen")
-                        mail.logout()
-                        logger.info(f"✅ 邮箱验证码获取成功: {code}")
-                        return code
-
-                    # 符合过滤但没码：标已读，避免反复卡住
-                    mail.store(mid, "+FLAGS", "\\Seen")
-
-                mail.logout()
-                if found_any_unread:
-                    logger.info("📭 有未读邮件，但未匹配 From/Subject 过滤条件，继续等待...")
-                else:
-                    logger.info("📭 暂无新验证码邮件，继续等待...")
-
-                time.sleep(poll_interval)
-
+                code, found_any_unread = await self.run_blocking(self._poll_once)
             except Exception as e:
-                logger.warning(f"⚠️ 拉取邮箱验证码失败，将重试: {e}")
-                time.sleep(poll_interval)
+                # 只有连接层错误才丢弃连接重连；其他错误（如 NO/BAD 应答）在原连接上重试
+                if isinstance(e, (imaplib.IMAP4.abort, OSError)):
+                    await self.run_blocking(self.close)
+                # 指数退避 + 抖动，避免 IMAP 认证限流时反复撞墙
+                backoff = min(30, poll_interval * (2 ** retry_idx)) + random.random()
+                retry_idx += 1
+                remaining = end_time - loop.time()
+                if remaining <= 0:
+                    break
+                backoff = min(backoff, remaining)  # 不越过总超时
+                logger.warning("⚠️ 拉取邮箱验证码失败，%.1fs 后重试: %s", backoff, e)
+                await asyncio.sleep(backoff)
+                continue
+
+            retry_idx = 0
+            if code:
+                logger.info("✅ 邮箱验证码获取成功: %s", code)
+                return code
+
+            if found_any_unread:
+                logger.info("📭 有未读邮件，但未匹配 From/Subject 过滤条件，继续等待...")
+                delay = self.POLL_DELAY_START  # 邮箱刚有动静，验证码可能紧随其后
+            else:
+                logger.info("📭 暂无新验证码邮件，继续等待...")
+
+            remaining = end_time - loop.time()
+            if remaining <= 0:
+                break
+            if use_idle:
+                try:
+                    # IDLE 单次最多挂 poll_interval*6 秒，之后照常 SEARCH 一次兜底
+                    if await self.run_blocking(self._idle_wait, min(poll_interval * 6, remaining)):
+                        logger.info("📬 收到新邮件推送，立即检查")
+                    continue
+                except RuntimeError as e:
+                    # 不支持/被拒绝：连接状态正常，直接改回轮询
+                    use_idle = False
+                    logger.info("ℹ️ IMAP IDLE 不可用，改为轮询: %s", e)
+                except Exception as e:
+                    # IDLE 中途断线：连接状态未知，丢弃后下一轮重连
+                    use_idle = False
+                    await self.run_blocking(self.close)
+                    logger.warning("⚠️ IMAP IDLE 中断，改为轮询: %s", e)
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * self.POLL_DELAY_FACTOR, self.POLL_DELAY_MAX)
 
         logger.error("❌ 等待邮箱验证码超时")
         return None
@@ -347,64 +863,176 @@ class EmailCodeFetcher:
 # ======================== 核心类 ==========================
 
 class XServerVPSRenewal:
-    def __init__(self):
-        self.browser = None
-        self.context = None
+    def __init__(self, vps_id: Optional[str] = None, shared: Optional["XServerVPSRenewal"] = None):
+        """
+        shared: 已登录的另一个实例；传入时复用它的浏览器/Context/邮箱连接，
+        只新开一个页面，跳过 Chromium 启动和登录
+        """
+        self.vps_id = vps_id or Config.VPS_ID
+        self.extend_index_url = Config.EXTEND_INDEX_URL_TPL.format(self.vps_id)
+        self.detail_url = Config.DETAIL_URL_TPL.format(self.vps_id)
+        self.cache_path = "cache.json" if self.vps_id == Config.VPS_ID else f"cache-{self.vps_id}.json"
+
+        self._owner = shared is None
+        self.browser = shared.browser if shared else None
+        self.context = shared.context if shared else None
         self.page = None
-        self._pw = None
+        self._pw = shared._pw if shared else None
+        self.logged_in: bool = shared.logged_in if shared else False
+        self.readme_peers: Optional[List["XServerVPSRenewal"]] = None  # 多台时 README 汇总的实例列表
+        # 未完成的通知任务；多台时与创建浏览器的实例共用，由它在 close() 里统一等待
+        self._notify_tasks: List[asyncio.Task] = shared._notify_tasks if shared else []
 
         self.renewal_status: str = "Unknown"
         self.old_expiry_time: Optional[str] = None
         self.new_expiry_time: Optional[str] = None
         self.error_message: Optional[str] = None
 
-        self.browser_exit_ip: Optional[str] = None
+        self.browser_exit_ip: Optional[str] = shared.browser_exit_ip if shared else None
+        self._ip_task: Optional[asyncio.Task] = None  # CHECK_EXIT_IP 开启时的后台查询
+
+        self.email_fetcher = shared.email_fetcher if shared else EmailCodeFetcher()
 
-        self.email_fetcher = EmailCodeFetcher()
+        self._cache: Optional[Dict] = None  # 本次运行内缓存 cache.json 的解析结果
 
     # ---------- 缓存 ----------
+    def load_cache(self) -> Dict:
+        if self._cache is not None:
+            return self._cache
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                self._cache = json.load(f)
+        except FileNotFoundError:
+            self._cache = {}
+        except Exception as e:
+            logger.warning(f"读取缓存失败: {e}")
+            self._cache = {}
+        return self._cache
+
     def save_cache(self):
         cache = {
             "last_expiry": self.old_expiry_time,
             "status": self.renewal_status,
             "last_check": datetime.datetime.now(timezone.utc).isoformat(),
-            "vps_id": Config.VPS_ID,
+            "vps_id": self.vps_id,
             "browser_exit_ip": self.browser_exit_ip,
             "runner_ip": Config.RUNNER_IP,
         }
         try:
-            with open("cache.json", "w", encoding="utf-8") as f:
-                json.dump(cache, f, indent=2, ensure_ascii=False)
+            # 先写临时文件再原子替换：中途崩溃也不会留下半截 JSON
+            tmp = f"{self.cache_path}.tmp"
+            if orjson is not None:
+                # 输出与 json.dump(indent=2, ensure_ascii=False) 一致（UTF-8 原样写出）
+                with open(tmp, "wb") as f:
+                    f.write(orjson.dumps(cache, option=orjson.OPT_INDENT_2))
+            else:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(cache, f, indent=2, ensure_ascii=False)
+            os.replace(tmp, self.cache_path)
+            self._cache = cache
         except Exception as e:
             logger.error(f"保存缓存失败: {e}")
 
+    def _fresh_cached_expiry(self) -> Optional[str]:
+        """
+        23 小时内同一台 VPS 续期失败过时，上次读到的到期日仍然有效，可跳过详情页
+        上次成功/状态不确定时到期日可能已变，必须重新读取
+        """
+        cache = self.load_cache()
+        if cache.get("vps_id") != self.vps_id or cache.get("status") != "Failed" or not cache.get("last_expiry"):
+            return None
+        try:
+            last_check = datetime.datetime.fromisoformat(cache["last_check"])
+        except (KeyError, TypeError, ValueError):
+            return None
+        if datetime.datetime.now(timezone.utc) - last_check > timedelta(hours=23):
+            return None
+        return cache["last_expiry"]
+
     # ---------- 截图 ----------
-    async def shot(self, name: str):
-        if not self.page:
+    async def shot(self, name: str, force: bool = False):
+        """
+        过程截图默认关闭（DEBUG_SHOTS=true 开启，视口 JPEG，开销小）
+        force=True 用于失败现场：总是截取整页 PNG，便于排查
+        """
+        page = self.page
+        if not page:
             return
+        if not self._owner:
+            name = f"{self.vps_id}_{name}"
         try:
-            await self.page.screenshot(path=f"{name}.png", full_page=True)
+            if force:
+                await page.screenshot(path=f"{name}.png", full_page=True)
+            elif Config.DEBUG_SHOTS:
+                await page.screenshot(path=f"{name}.jpg", type="jpeg", quality=Config.SHOT_QUALITY, full_page=False)
         except Exception:
             pass
 
+    # ---------- 页面文本 ----------
+    async def _page_text(self, limit: int = 0) -> str:
+        """
+        通过预加载的 window.__xs_text 取 body 文本（见 PAGE_HELPERS_JS）
+        limit>0 时在页面内压缩空白并截断
+        """
+        return (await self.page.evaluate("(n) => window.__xs_text(n)", limit)) or ""
+
     # ---------- 获取浏览器出口 IP ----------
     async def _get_browser_exit_ip(self) -> Optional[str]:
+        """
+        ipify 是纯文本接口，不需要渲染：用 Context 自带的 APIRequestContext 请求，不开新页面，
+        但与页面走同一网络出口（含 Context/浏览器的代理设置）；每次运行只查一次
+        """
+        if self.browser_exit_ip:
+            return self.browser_exit_ip
         try:
-            tmp = await self.context.new_page()
-            tmp.set_default_timeout(15000)
-            await tmp.goto("https://api.ipify.org", wait_until="domcontentloaded")
-            text = (await tmp.text_content("body")) or ""
-            ip = text.strip()
-            await tmp.close()
-            if re.match(r"^\d{1,3}(\.\d{1,3}){3}$", ip):
+            resp = await self.context.request.get("https://api.ipify.org", timeout=8000)
+            ip = (await resp.text()).strip()
+            await resp.dispose()
+            if _IPV4.match(ip):
                 return ip
             return None
         except Exception:
             return None
 
+    async def _probe_exit_ip(self):
+        self.browser_exit_ip = await self._get_browser_exit_ip()
+        if self.browser_exit_ip:
+            logger.info(f"🌐 浏览器出口 IP: {self.browser_exit_ip}")
+        else:
+            logger.warning("⚠️ 未能获取浏览器出口 IP")
+
+        if Config.RUNNER_IP:
+            logger.info(f"🌍 GitHub Runner 出口 IP: {Config.RUNNER_IP}")
+
+        if self.browser_exit_ip and Config.RUNNER_IP and self.browser_exit_ip == Config.RUNNER_IP:
+            logger.warning(f"⚠️ browser_exit_ip == runner_ip == {self.browser_exit_ip}（当前策略允许直连，继续执行）")
+
+    async def _write_outputs(self, cache: bool = False):
+        """写 README（及缓存）：先等后台出口 IP 查询结束，两者都要记录它"""
+        if self._ip_task is not None:
+            await self._ip_task
+        jobs = [asyncio.to_thread(self.generate_readme)]
+        if cache:
+            jobs.append(asyncio.to_thread(self.save_cache))
+        await asyncio.gather(*jobs)
+
     # ---------- 浏览器 ----------
     async def setup_browser(self) -> bool:
+        if not self._owner:
+            # 复用已登录的 Context（Cookie 与 init script 已在其上），只开新页面
+            try:
+                self.page = await self.context.new_page()
+                self.page.set_default_timeout(Config.WAIT_TIMEOUT)
+                if STEALTH_VERSION == "old" and stealth_async is not None:
+                    await stealth_async(self.page)
+                return True
+            except Exception as e:
+                logger.error(f"❌ 新建页面失败: {e}")
+                self.error_message = str(e)
+                return False
+
         try:
+            # 整个运行只启动一个 Playwright + Browser + Context，后续页面操作都复用 self.page
             self._pw = await async_playwright().start()
 
             launch_args = [
@@ -441,39 +1069,34 @@ class XServerVPSRenewal:
                 ),
             }
 
+            if Config.STATE_FILE and os.path.exists(Config.STATE_FILE):
+                context_options["storage_state"] = Config.STATE_FILE
+                logger.info(f"ℹ️ 已载入登录态: {Config.STATE_FILE}")
+
             self.context = await self.browser.new_context(**context_options)
 
-            await self.context.add_init_script("""
-Object.defineProperty(navigator, 'webdriver', {get: () => undefined});
-Object.defineProperty(navigator, 'plugins', {get: () => [1,2,3]});
-Object.defineProperty(navigator, 'languages', {get: () => ['zh-CN','ja-JP','en-US']});
-Object.defineProperty(navigator, 'permissions', {
-    get: () => ({
-        query: ({name}) => Promise.resolve({state: 'granted'})
-    })
-});
-""")
+            if Config.BLOCK_ASSETS:
+                await self.context.route(_XSERVER_URL, _block_assets)
+                logger.info("ℹ️ 已拦截 XServer 页面的图片/字体/媒体请求")
+
+            # stealth 与自定义覆盖二选一：重复覆盖 navigator 属性本身就是指纹
+            use_stealth = STEALTH_VERSION == "old" and stealth_async is not None
+            if not use_stealth:
+                await self.context.add_init_script(STEALTH_SCRIPT)
+            await self.context.add_init_script(PAGE_HELPERS_JS)
 
             self.page = await self.context.new_page()
             self.page.set_default_timeout(Config.WAIT_TIMEOUT)
 
-            if STEALTH_VERSION == "old" and stealth_async is not None:
+            if use_stealth:
                 await stealth_async(self.page)
                 logger.info("✅ 已启用 playwright-stealth(old)")
             else:
-                logger.info("ℹ️ 未启用 stealth（未安装或非 old 版本）")
-
-            self.browser_exit_ip = await self._get_browser_exit_ip()
-            if self.browser_exit_ip:
-                logger.info(f"🌐 浏览器出口 IP: {self.browser_exit_ip}")
-            else:
-                logger.warning("⚠️ 未能获取浏览器出口 IP")
-
-            if Config.RUNNER_IP:
-                logger.info(f"🌍 GitHub Runner 出口 IP: {Config.RUNNER_IP}")
+                logger.info("ℹ️ 未启用 stealth（未安装或非 old 版本），使用内置 navigator 覆盖脚本")
 
-            if self.browser_exit_ip and Config.RUNNER_IP and self.browser_exit_ip == Config.RUNNER_IP:
-                logger.warning(f"⚠️ browser_exit_ip == runner_ip == {self.browser_exit_ip}（当前策略允许直连，继续执行）")
+            if Config.CHECK_EXIT_IP:
+                # 出口 IP 只用于日志/README：后台查询，不占登录关键路径
+                self._ip_task = asyncio.create_task(self._probe_exit_ip())
 
             logger.info("✅ 浏览器初始化成功")
             return True
@@ -488,7 +1111,8 @@ Object.defineProperty(navigator, 'permissions', {
         try:
             logger.info("🌐 开始登录")
             await self.page.goto(Config.LOGIN_URL, timeout=30000)
-            await asyncio.sleep(2)
+            # 表单出现即可填写，不再固定 sleep
+            await self.page.wait_for_selector("input[name='memberid']", state="visible", timeout=10000)
             await self.shot("01_login")
 
             await self.page.fill("input[name='memberid']", Config.LOGIN_EMAIL or "")
@@ -496,8 +1120,16 @@ Object.defineProperty(navigator, 'permissions', {
             await self.shot("02_before_submit")
 
             logger.info("📤 提交登录表单...")
-            await self.page.click("input[type='submit']")
-            await asyncio.sleep(5)
+            # 提交后等页面真正跳转完成（成功页/验证页都会发生跳转），不再固定 sleep
+            clicked = False
+            try:
+                async with self.page.expect_navigation(wait_until="domcontentloaded", timeout=15000):
+                    await self.page.locator(SEL_LOGIN_SUBMIT).first.click()
+                    clicked = True
+            except PlaywrightTimeoutError:
+                if not clicked:
+                    raise
+                logger.warning("⚠️ 提交登录表单后未检测到页面跳转，继续按当前页面判断")
             await self.shot("03_after_submit")
 
             current_url = self.page.url
@@ -507,21 +1139,20 @@ Object.defineProperty(navigator, 'permissions', {
                 logger.info("🎉 登录成功")
                 return True
 
-            # 是否进入“新环境登录验证/邮箱验证码”页
-            page_text = ""
+            # 是否进入“新环境登录验证/邮箱验证码”页：由浏览器内部轮询，文案一出现就返回
+            need_env_verify = False
             try:
-                page_text = await self.page.evaluate("() => (document.body.innerText || document.body.textContent || '')")
-            except Exception:
-                page_text = ""
-
-            need_env_verify = (
-                ("新しい環境からのログイン" in page_text) or
-                ("ログイン用認証コード" in page_text) or
-                ("認証コードを送信" in page_text) or
-                (("認証コード" in page_text) and ("送信" in page_text))
-            )
+                await self.page.wait_for_function(
+                    "([a, b]) => window.__xs_hasKeywords(a, b)",
+                    arg=[list(ENV_VERIFY_KEYWORDS), list(ENV_VERIFY_ALL_OF)],
+                    timeout=5000,
+                )
+                need_env_verify = True
+            except PlaywrightTimeoutError:
+                need_env_verify = False
 
             if not need_env_verify:
+                await self.shot("03b_login_failed", force=True)
                 self.error_message = f"登录失败（未检测到邮箱验证页）：url={current_url}"
                 logger.error(f"❌ {self.error_message}")
                 return False
@@ -529,21 +1160,24 @@ Object.defineProperty(navigator, 'permissions', {
             logger.warning("🔐 检测到“新环境登录验证/邮箱验证码”页面，尝试自动发送验证码并收码...")
 
             # ✅ 方案C：先清理旧未读验证码邮件（必须在“发送验证码”前）
-            self.email_fetcher.mark_old_unseen_as_seen()
+            await self.email_fetcher.run_blocking(self.email_fetcher.mark_old_unseen_as_seen)
 
             # 1) 点击“发送验证码”
             sent = False
             try:
-                btn = self.page.locator(
-                    "input[type='submit'][value*='送信'], button:has-text('送信'), button[type='submit'], input[type='submit']"
-                ).first
-                if await btn.count() > 0:
-                    await btn.click()
-                    sent = True
+                btn = self.page.locator(SEL_SEND_CODE).first
+                await btn.wait_for(state="visible", timeout=3000)
+                await btn.click()
+                sent = True
             except Exception:
                 sent = False
 
-            await asyncio.sleep(2)
+            # 发送后（跳转或页内切换）验证码输入框会出现：等它出现即可，不再固定 sleep
+            if sent:
+                try:
+                    await self.page.locator(SEL_CODE_INPUT).first.wait_for(state="visible", timeout=5000)
+                except PlaywrightTimeoutError:
+                    pass
             await self.shot("03c_after_send_code")
 
             if not sent:
@@ -556,7 +1190,7 @@ Object.defineProperty(navigator, 'permissions', {
             logger.info("📧 等待邮箱验证码（IMAP 轮询）...")
             code = None
             try:
-                code = await asyncio.to_thread(self.email_fetcher.fetch_latest_code, 120, 5)
+                code = await self.email_fetcher.fetch_latest_code(120, 5)
             except Exception as e:
                 logger.error(f"❌ 邮箱取码异常: {e}")
 
@@ -571,34 +1205,20 @@ Object.defineProperty(navigator, 'permissions', {
 
             filled = False
             try:
-                inp = self.page.locator(
-                    "input[type='text'], input[type='tel'], input[name*='code'], input[name*='auth']"
-                ).first
-                if await inp.count() > 0:
-                    await inp.fill(code)
-                    filled = True
+                inp = self.page.locator(SEL_CODE_INPUT).first
+                await inp.wait_for(state="visible", timeout=3000)
+                await inp.fill(code)
+                filled = True
             except Exception:
                 filled = False
 
             if not filled:
+                # 兜底：不等可见，直接取一次元素句柄填写（fill 自带 input/change 事件）
                 try:
-                    filled = await self.page.evaluate("""
-                        (code) => {
-                            const inputs = Array.from(document.querySelectorAll('input'));
-                            const target = inputs.find(i => {
-                                const n = (i.name || '').toLowerCase();
-                                const p = (i.placeholder || '').toLowerCase();
-                                return i.type === 'text' || i.type === 'tel' ||
-                                       n.includes('code') || n.includes('auth') ||
-                                       p.includes('認証') || p.includes('code');
-                            });
-                            if (!target) return false;
-                            target.value = code;
-                            target.dispatchEvent(new Event('input', { bubbles: true }));
-                            target.dispatchEvent(new Event('change', { bubbles: true }));
-                            return true;
-                        }
-                    """, code)
+                    inp_el = await self.page.query_selector(SEL_CODE_INPUT)
+                    if inp_el:
+                        await inp_el.fill(code, force=True)
+                        filled = True
                 except Exception:
                     filled = False
 
@@ -612,17 +1232,22 @@ Object.defineProperty(navigator, 'permissions', {
 
             submitted = False
             try:
-                btn2 = self.page.locator(
-                    "button:has-text('認証'), button:has-text('確認'), input[type='submit'], button[type='submit']"
-                ).first
-                if await btn2.count() > 0:
+                btn2 = self.page.locator(SEL_VERIFY_BTN).first
+                await btn2.wait_for(state="visible", timeout=3000)
+                async with self.page.expect_navigation(wait_until="domcontentloaded", timeout=15000):
                     await btn2.click()
-                    submitted = True
+                submitted = True
             except Exception:
                 submitted = False
 
-            await asyncio.sleep(6)
-            await self.shot("03e_after_verify_submit")
+            # 验证通过后可能还有一次重定向：等 URL 离开登录页（最多 5 秒），否则按当前页面判断
+            if submitted:
+                try:
+                    await self.page.wait_for_url(lambda u: "login" not in u.lower(), timeout=5000)
+                except PlaywrightTimeoutError:
+                    pass
+
+            await self.shot("03e_after_verify_submit", force=True)
 
             current_url = self.page.url
             if "xvps/index" in current_url or ("login" not in current_url.lower()):
@@ -631,12 +1256,7 @@ Object.defineProperty(navigator, 'permissions', {
 
             hint = ""
             try:
-                hint = await self.page.evaluate("""
-                    () => {
-                        const t = (document.body.innerText || '').replace(/\\s+/g, ' ').trim();
-                        return t.slice(0, 350);
-                    }
-                """)
+                hint = await self._page_text(limit=350)
             except Exception:
                 hint = ""
 
@@ -650,33 +1270,50 @@ Object.defineProperty(navigator, 'permissions', {
             self.error_message = f"登录错误: {e}"
             return False
 
+    # ---------- 登录态复用 ----------
+    async def restore_session(self) -> bool:
+        """带着已保存的登录态直接打开详情页；没被重定向回登录页即视为已登录"""
+        if not (Config.STATE_FILE and os.path.exists(Config.STATE_FILE)):
+            return False
+        try:
+            await self.page.goto(self.detail_url, timeout=30000)
+        except Exception as e:
+            logger.warning(f"⚠️ 登录态校验失败，改为重新登录: {e}")
+            return False
+        if "login" in (self.page.url or "").lower():
+            logger.info("ℹ️ 保存的登录态已失效，重新登录")
+            return False
+        logger.info("🎉 已复用保存的登录态，跳过登录")
+        return True
+
+    async def save_session(self):
+        if not Config.STATE_FILE:
+            return
+        try:
+            await self.context.storage_state(path=Config.STATE_FILE)
+        except Exception as e:
+            logger.warning(f"保存登录态失败: {e}")
+
     # ---------- 获取到期时间（旧 xvps 页面读取） ----------
     async def get_expiry(self) -> bool:
+        page = self.page
         try:
-            await self.page.goto(Config.DETAIL_URL, timeout=30000)
-            await asyncio.sleep(3)
+            # restore_session 已打开详情页时不再重复导航
+            if page.url != self.detail_url:
+                await page.goto(self.detail_url, timeout=30000)
+            # 等「利用期限」所在行出现即可解析，不再固定 sleep
+            try:
+                await page.wait_for_selector("tr:has-text('利用期限')", timeout=10000)
+            except PlaywrightTimeoutError:
+                pass
             await self.shot("04_detail")
 
-            expiry_date = await self.page.evaluate("""
-                () => {
-                    const rows = document.querySelectorAll('tr');
-                    for (const row of rows) {
-                        const text = row.innerText || row.textContent;
-                        if (text.includes('利用期限') && !text.includes('利用開始')) {
-                            const match = text.match(/(\\d{4})年(\\d{1,2})月(\\d{1,2})日/);
-                            if (match) return {year: match[1], month: match[2], day: match[3]};
-                        }
-                    }
-                    return null;
-                }
-            """)
+            # 一次取回正文文本，用预编译正则找「利用期限」那一行，不在页面内逐行遍历 tr
+            m = _EXPIRY_RE.search(await self._page_text())
+            expiry_date = f"{m.group(1)}-{int(m.group(2)):02d}-{int(m.group(3)):02d}" if m else None
 
             if expiry_date:
-                self.old_expiry_time = (
-                    f"{expiry_date['year']}-"
-                    f"{expiry_date['month'].zfill(2)}-"
-                    f"{expiry_date['day'].zfill(2)}"
-                )
+                self.old_expiry_time = expiry_date
                 logger.info(f"📅 利用期限: {self.old_expiry_time}")
                 return True
 
@@ -686,6 +1323,21 @@ Object.defineProperty(navigator, 'permissions', {
             logger.error(f"❌ 获取到期时间失败: {e}")
             return False
 
+    async def _resolve_button(self, primary: str, fallback: str, timeout: int = 10000):
+        """
+        先等主选择器的可见元素出现（按钮出现即继续，不再固定 sleep），超时后再看兜底选择器
+        两组都只取可见元素：页面前部隐藏的同名链接（折叠菜单等）不会被 .first 选中，
+        也不会在确认页还没渲染完时抢先点到页头导航里的兜底链接；都没有时返回 None
+        """
+        main = self.page.locator(f"{primary} >> visible=true").first
+        try:
+            await main.wait_for(state="visible", timeout=timeout)
+            return main
+        except PlaywrightTimeoutError:
+            pass
+        fb = self.page.locator(f"{fallback} >> visible=true")
+        return fb.first if await fb.count() else None
+
     # ---------- 续期：跳转 + 输入页两次确认 ----------
     async def extend_flow(self) -> bool:
         """
@@ -695,9 +1347,13 @@ Object.defineProperty(navigator, 'permissions', {
           3) 点击「確認画面に進む」→ 点击「期限を延長する」
         """
         try:
-            logger.info(f"🌐 访问 jumpvps 跳转页: {Config.EXTEND_INDEX_URL}")
-            await self.page.goto(Config.EXTEND_INDEX_URL, timeout=Config.WAIT_TIMEOUT)
-            await asyncio.sleep(2)
+            logger.info(f"🌐 访问 jumpvps 跳转页: {self.extend_index_url}")
+            await self.page.goto(self.extend_index_url, timeout=Config.WAIT_TIMEOUT)
+            # 跳转页可能还有后续重定向/写 Cookie：等网络空闲再继续
+            try:
+                await self.page.wait_for_load_state("networkidle", timeout=10000)
+            except PlaywrightTimeoutError:
+                pass
             await self.shot("05_jumpvps")
 
             # 简单判定：页面能打开就继续；如果被重定向到登录页则认为失败
@@ -709,53 +1365,55 @@ Object.defineProperty(navigator, 'permissions', {
 
             logger.info(f"🌐 访问续期输入页: {Config.EXTEND_INPUT_URL}")
             await self.page.goto(Config.EXTEND_INPUT_URL, timeout=Config.WAIT_TIMEOUT)
-            await asyncio.sleep(2)
-            await self.shot("06_extend_input")
 
-            # 第一步：确认页
-            step1 = self.page.locator(
-                "button:has-text('確認画面に進む'), a:has-text('確認画面に進む'), input[type='submit'][value*='確認']"
-            ).first
-            if await step1.count() == 0:
-                step1 = self.page.locator("button:has-text('確認'), a:has-text('確認')").first
+            # 第一步：确认页（按钮出现即继续，不再固定 sleep）
+            step1 = await self._resolve_button(SEL_CONFIRM_BTN, SEL_CONFIRM_FALLBACK)
+            await self.shot("06_extend_input")
 
-            if await step1.count() == 0:
+            if step1 is None:
                 self.error_message = "续期失败：未找到「確認画面に進む/確認」按钮"
                 logger.error(f"❌ {self.error_message}")
-                await self.shot("06b_no_confirm_button")
+                await self.shot("06b_no_confirm_button", force=True)
                 return False
 
             logger.info("🖱️ 续期第1步：点击「確認画面に進む」")
             await step1.click()
-            await asyncio.sleep(2)
-            await self.shot("07_extend_confirm")
 
-            # 第二步：延长
-            step2 = self.page.locator(
-                "button:has-text('期限を延長する'), a:has-text('期限を延長する'), input[type='submit'][value*='延長']"
-            ).first
-            if await step2.count() == 0:
-                step2 = self.page.locator("button:has-text('延長'), a:has-text('延長')").first
+            # 第二步：延长（确认页的「期限を延長する」出现即继续，不再固定 sleep）
+            step2 = await self._resolve_button(SEL_EXTEND_BTN, SEL_EXTEND_FALLBACK)
+            await self.shot("07_extend_confirm")
 
-            if await step2.count() == 0:
+            if step2 is None:
                 self.error_message = "续期失败：未找到「期限を延長する/延長」按钮"
                 logger.error(f"❌ {self.error_message}")
-                await self.shot("07b_no_extend_button")
+                await self.shot("07b_no_extend_button", force=True)
                 return False
 
             logger.info("🖱️ 续期第2步：点击「期限を延長する」")
-            await step2.click()
-            await asyncio.sleep(3)
+            # 提交后等结果页加载完成；若是页面内异步提交（无跳转），超时后按当前页面判断
+            clicked = False
+            try:
+                async with self.page.expect_navigation(wait_until="domcontentloaded", timeout=15000):
+                    await step2.click()
+                    clicked = True
+            except PlaywrightTimeoutError:
+                if not clicked:
+                    raise
+                logger.warning("⚠️ 点击「期限を延長する」后未检测到页面跳转，按当前页面判断")
             await self.shot("08_extend_done")
 
-            # 简单成功判定
-            page_text = ""
+            # 简单成功判定：关键字在页面内匹配，只回传一个短结果，不把整页文本拉回 Python。
+            # 仍看整个 body：结果页的正文容器没有实测确认过，猜错容器会把成功判成 unknown
+            verdict = "unknown"
             try:
-                page_text = await self.page.evaluate("() => (document.body.innerText || document.body.textContent || '')")
+                hit = await self.page.evaluate(
+                    "(a) => window.__xs_hasKeywords(a, [])", list(EXTEND_OK_KEYWORDS)
+                )
+                verdict = "ok" if hit else "unknown"
             except Exception:
-                page_text = ""
+                verdict = "unknown"
 
-            if any(k in page_text for k in ["完了", "延長", "成功", "更新"]):
+            if verdict == "ok":
                 logger.info("🎉 续期操作已提交（页面出现成功/完成提示）")
                 self.renewal_status = "Success"
                 return True
@@ -770,31 +1428,41 @@ Object.defineProperty(navigator, 'permissions', {
             return False
 
     # ---------- README ----------
-    def generate_readme(self):
-        now = datetime.datetime.now(timezone(timedelta(hours=8)))
-        ts = now.strftime("%Y-%m-%d %H:%M:%S")
-
-        out = "# XServer VPS 自动续期状态\n\n"
-        out += f"**运行时间**: `{ts} (UTC+8)`<br>\n"
-        out += f"**VPS ID**: `{Config.VPS_ID}`<br>\n"
-        out += f"**Runner IP**: `{Config.RUNNER_IP or '未知'}`<br>\n"
-        out += f"**浏览器出口 IP**: `{self.browser_exit_ip or '未知'}`<br>\n\n---\n\n"
-
+    def _readme_status(self, h: str = "##") -> str:
+        out = ""
         if self.renewal_status == "Success":
-            out += "## ✅ 续期成功\n\n"
+            out += f"{h} ✅ 续期成功\n\n"
             if self.old_expiry_time:
                 out += f"- 🕛 **到期时间（旧面板读取）**: `{self.old_expiry_time}`\n"
         elif self.renewal_status == "NeedVerify":
-            out += "## 🔐 需要邮箱验证/收码失败\n\n"
+            out += f"{h} 🔐 需要邮箱验证/收码失败\n\n"
             out += f"- ⚠️ **原因**: {self.error_message or '未知'}\n"
         elif self.renewal_status == "Failed":
-            out += "## ❌ 续期失败\n\n"
+            out += f"{h} ❌ 续期失败\n\n"
             out += f"- ⚠️ **错误**: {self.error_message or '未知'}\n"
         else:
-            out += "## ⚠️ 续期完成但状态不确定\n\n"
+            out += f"{h} ⚠️ 续期完成但状态不确定\n\n"
             out += "- 已完成两次点击，但未匹配到明确成功关键字（请查看截图）\n"
             if self.error_message:
                 out += f"- ⚠️ **提示**: {self.error_message}\n"
+        return out
+
+    def generate_readme(self):
+        now = datetime.datetime.now(CST)
+        ts = now.strftime("%Y-%m-%d %H:%M:%S")
+        peers = self.readme_peers or [self]
+
+        out = "# XServer VPS 自动续期状态\n\n"
+        out += f"**运行时间**: `{ts} (UTC+8)`<br>\n"
+        out += f"**VPS ID**: `{', '.join(r.vps_id for r in peers)}`<br>\n"
+        out += f"**Runner IP**: `{Config.RUNNER_IP or '未知'}`<br>\n"
+        out += f"**浏览器出口 IP**: `{self.browser_exit_ip or '未知'}`<br>\n\n---\n\n"
+
+        if len(peers) == 1:
+            out += self._readme_status()
+        else:
+            for r in peers:
+                out += f"## 🖥️ VPS `{r.vps_id}`\n\n" + r._readme_status("###") + "\n"
 
         out += f"\n---\n\n*最后更新: {ts}*\n"
 
@@ -803,70 +1471,150 @@ Object.defineProperty(navigator, 'permissions', {
 
         logger.info("📄 README.md 已更新")
 
+    def notify(self, subject: str, message: str) -> None:
+        """通知放到后台任务发送，与浏览器关闭并行；close() 里统一等待（见 _drain_notifications）"""
+        if len(Config.VPS_IDS) > 1:
+            message = f"[VPS {self.vps_id}] {message}"
+        self._notify_tasks.append(asyncio.create_task(Notifier.notify(subject, message)))
+
+    async def _drain_notifications(self, timeout: Optional[float] = None):
+        """
+        等后台通知发完；默认时限覆盖 Notifier 的完整重试策略（按并发数分批计算），
+        否则慢请求和重试会被中途取消，恰好丢掉 Telegram 变慢时最要紧的失败通知
+        """
+        if not self._notify_tasks:
+            return
+        if timeout is None:
+            waves = -(-len(self._notify_tasks) // Notifier.CONCURRENCY)
+            timeout = waves * Notifier.worst_case_sec() + 2
+        done, pending = await asyncio.wait(self._notify_tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"⚠️ {len(pending)} 条通知在 {timeout}s 内未发送完成，已放弃")
+        self._notify_tasks.clear()
+
     # ---------- 主流程 ----------
-    async def run(self):
+    async def run(self, keep_open: bool = False):
+        """keep_open=True 时结束后不关闭浏览器，供后续 VPS 复用（由调用方 close）"""
         try:
             logger.info("=" * 60)
-            logger.info("🚀 XServer VPS 自动续期开始")
+            logger.info(f"🚀 XServer VPS 自动续期开始 (VPS {self.vps_id})")
             logger.info("=" * 60)
 
             # 1) 浏览器
             if not await self.setup_browser():
                 self.renewal_status = "Failed"
-                self.generate_readme()
-                await Notifier.notify("❌ 失败", self.error_message or "浏览器初始化失败")
-                return
-
-            # 2) 登录（含邮箱验证）
-            if not await self.login():
-                if self.renewal_status == "Unknown":
-                    self.renewal_status = "Failed"
-                self.generate_readme()
-                await Notifier.notify("❌ 登录失败", self.error_message or "登录失败")
+                self.notify("❌ 失败", self.error_message or "浏览器初始化失败")
+                await self._write_outputs()
                 return
 
-            # 3) 读取到期日（旧面板）
-            await self.get_expiry()
-
-            # 4) 续期流程（jumpvps -> extend/input -> 确認 -> 延長）
+            # 2) 登录（含邮箱验证）；复用已登录的 Context 或保存的登录态有效时跳过
+            if not self.logged_in and await self.restore_session():
+                self.logged_in = True
+            if not self.logged_in:
+                if not await self.login():
+                    if self.renewal_status == "Unknown":
+                        self.renewal_status = "Failed"
+                    self.notify("❌ 登录失败", self.error_message or "登录失败")
+                    await self._write_outputs()
+                    return
+                self.logged_in = True
+                await self.save_session()
+
+            # 3) 读取到期日（旧面板）+ 4) 续期流程（jumpvps -> extend/input -> 确認 -> 延長）
+            cached_expiry = self._fresh_cached_expiry()
+            if cached_expiry:
+                # 上次失败时刚读过到期日：直接复用，省掉详情页往返
+                self.old_expiry_time = cached_expiry
+                logger.info(f"📅 利用期限（缓存）: {self.old_expiry_time}")
+            else:
+                # 详情页必须在 jumpvps 之前读完：jumpvps 切换服务端会话里选中的服务，
+                # 同一会话里并行加载 detail?id= 可能插在 jumpvps 与延长提交之间，或刷新表单令牌
+                # （复用登录态时详情页已打开，get_expiry 不会重复导航）
+                await self.get_expiry()
             ok = await self.extend_flow()
             if not ok:
                 self.renewal_status = "Failed"
-                self.generate_readme()
-                await Notifier.notify("❌ 续期失败", self.error_message or "续期失败")
+                self.notify("❌ 续期失败", self.error_message or "续期失败")
+                # 失败也记下本次读到的到期日，23 小时内重试可跳过详情页（见 _fresh_cached_expiry）
+                await self._write_outputs(cache=True)
                 return
 
-            # 5) 输出
-            self.save_cache()
-            self.generate_readme()
-
+            # 5) 输出：通知（后台任务）与缓存/README 写入（本地文件）互不依赖，并发执行
             if self.renewal_status == "Success":
-                await Notifier.notify("✅ 续期成功", "已完成续期两次确认流程（建议查看截图确认页面提示）")
+                subject, message = "✅ 续期成功", "已完成续期两次确认流程（建议查看截图确认页面提示）"
             else:
-                await Notifier.notify("⚠️ 续期完成但状态不确定", "已完成两次点击，但未匹配到明确成功关键字，请看截图。")
+                subject, message = "⚠️ 续期完成但状态不确定", "已完成两次点击，但未匹配到明确成功关键字，请看截图。"
+
+            self.notify(subject, message)
+            await self._write_outputs(cache=True)
 
         finally:
             logger.info("=" * 60)
             logger.info(f"✅ 流程完成 - 状态: {self.renewal_status}")
             logger.info("=" * 60)
 
+            if not keep_open:
+                await self.close()
+
+    async def close(self):
+        """关闭本实例的页面；浏览器/Context/邮箱/HTTP 只由创建它们的实例关闭"""
+        if self._ip_task is not None and not self._ip_task.done():
+            self._ip_task.cancel()
+        # 创建者直接关 Context（其下页面随之关闭），不再逐个关页面；每步单独兜底，前一步出错不影响后续释放
+        if self._owner:
+            steps = [self.context and self.context.close, self.browser and self.browser.close, self._pw and self._pw.stop]
+        else:
+            steps = [self.page and self.page.close]
+        for step in steps:
+            if not step:
+                continue
             try:
-                if self.page:
-                    await self.page.close()
-                if self.context:
-                    await self.context.close()
-                if self.browser:
-                    await self.browser.close()
-                if self._pw:
-                    await self._pw.stop()
-                logger.info("🧹 浏览器已关闭")
+                await step()
             except Exception as e:
                 logger.warning(f"关闭浏览器时出错: {e}")
+        if self._owner and self.browser:
+            logger.info("🧹 浏览器已关闭")
+
+        if self._owner:
+            # 浏览器已关：再等后台通知发完（含重试，见 _drain_notifications），之后才能关闭 HTTP 会话
+            await self._drain_notifications()
+            await self.cleanup()
+
+    async def cleanup(self):
+        try:
+            await self.email_fetcher.shutdown()
+        except Exception as e:
+            logger.warning(f"关闭 IMAP 连接时出错: {e}")
+
+        try:
+            await _close_http()
+        except Exception as e:
+            logger.warning(f"关闭 HTTP 会话时出错: {e}")
 
 
 async def main():
-    runner = XServerVPSRenewal()
-    await runner.run()
+    first = XServerVPSRenewal(Config.VPS_IDS[0])
+    if len(Config.VPS_IDS) == 1:
+        await first.run()
+        return
+
+    # 多台 VPS：只启动一次 Chromium、登录一次，其余 VPS 复用同一个 Context 依次续期
+    runners = [first]
+    first.readme_peers = runners
+    try:
+        await first.run(keep_open=True)
+        for vps_id in Config.VPS_IDS[1:]:
+            if not first.logged_in:
+                logger.warning(f"⚠️ 登录未成功，跳过 VPS {vps_id}")
+                continue
+            runner = XServerVPSRenewal(vps_id, shared=first)
+            runners.append(runner)
+            runner.readme_peers = runners
+            await runner.run()
+    finally:
+        await first.close()
 
 
 if __name__ == "__main__":